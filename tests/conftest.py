@@ -14,6 +14,12 @@ from _pytest.assertion.rewrite import AssertionRewritingHook
 
 def pytest_addoption(parser):
     parser.addoption('--test-mypy', action='store_true', help='run mypy tests')
+    parser.addoption('--mypy-traceback', action='store_true', help='show tracebacks from mypy crashes in mypy tests')
+
+
+def pytest_configure(config):
+    # registered by pytest-xdist when it's installed, but the mypy tests use it either way
+    config.addinivalue_line('markers', 'xdist_group(name): run all tests in the group on the same xdist worker')
 
 
 def _extract_source_code_from_function(function):
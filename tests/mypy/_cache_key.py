@@ -0,0 +1,30 @@
+"""
+Print a key for persisting the mypy test caches between CI runs.
+
+The key changes whenever the test modules, the test configs, mypy or the python version change, usage:
+
+    PYDANTIC_MYPY_CACHE_ROOT=<cached directory> pytest tests/mypy --test-mypy
+
+with the directory cached under the key printed by `python tests/mypy/_cache_key.py`.
+"""
+import hashlib
+import sys
+from pathlib import Path
+
+from mypy.version import __version__ as mypy_version
+
+THIS_DIR = Path(__file__).parent
+
+
+def cache_key() -> str:
+    h = hashlib.sha256(f'mypy={mypy_version} python={sys.version_info[0]}.{sys.version_info[1]}'.encode())
+    for pattern in 'modules/**/*.py', 'configs/**/*':
+        for path in sorted(THIS_DIR.glob(pattern)):
+            if path.is_file():
+                h.update(path.relative_to(THIS_DIR).as_posix().encode())
+                h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+if __name__ == '__main__':
+    print(cache_key())